@@ -8,6 +8,75 @@
 import numpy as np
 import torch
 import math
+import functools
+from collections import namedtuple
+
+PatchGeometry = namedtuple('PatchGeometry', ['patch_num_x', 'patch_num_y', 'stride_x', 'stride_y', 'pad_x_right', 'pad_y_right', 'fold_shape_x', 'fold_shape_y'])
+
+def patch_geometry(img_shape_y,
+        img_shape_x,
+        patch_shape_y,
+        patch_shape_x,
+        overlap_pix,
+        boundary_pix):
+    '''
+    patch layout shared by image_batching and image_fuse
+    stride: distance between the starts of neighbouring patches
+    pad_right: reflection padding appended on the right/bottom so the last patch fits
+    fold_shape: area covered by the patches once their boundary pixels are cropped
+    '''
+    stride_x = patch_shape_x-overlap_pix-boundary_pix
+    stride_y = patch_shape_y-overlap_pix-boundary_pix
+    patch_num_x = math.ceil(img_shape_x/stride_x)
+    patch_num_y = math.ceil(img_shape_y/stride_y)
+    padded_shape_x = stride_x * (patch_num_x-1) + patch_shape_x + boundary_pix
+    padded_shape_y = stride_y * (patch_num_y-1) + patch_shape_y + boundary_pix
+    pad_x_right = padded_shape_x - img_shape_x - boundary_pix
+    pad_y_right = padded_shape_y - img_shape_y - boundary_pix
+    fold_shape_x = stride_x*(patch_num_x-1) + patch_shape_x-2*boundary_pix
+    fold_shape_y = stride_y*(patch_num_y-1) + patch_shape_y-2*boundary_pix
+    return PatchGeometry(patch_num_x, patch_num_y, stride_x, stride_y, pad_x_right, pad_y_right, fold_shape_x, fold_shape_y)
+
+def precompute_unfold_view(img_shape_y,
+        img_shape_x,
+        patch_shape_y,
+        patch_shape_x,
+        batch_size,
+        overlap_pix,
+        boundary_pix,
+        geom=None):
+    '''
+    image_batching with everything that only depends on the shapes resolved once
+    returns batching(input, input_interp=None, out=None, materialize=True), to be reused for every input of these shapes
+    '''
+    if geom is None:
+        geom = patch_geometry(img_shape_y, img_shape_x, patch_shape_y, patch_shape_x, overlap_pix, boundary_pix)
+    patch_num_x, patch_num_y, stride_x, stride_y, pad_x_right, pad_y_right, _, _ = geom
+    patch_num = patch_num_x*patch_num_y
+    padding = (boundary_pix, pad_x_right, boundary_pix, pad_y_right) #(padding_left,padding_right,padding_top,padding_bottom)
+    covered_shape_x = stride_x*(patch_num_x-1)+patch_shape_x # trailing boundary pixels are never covered
+    covered_shape_y = stride_y*(patch_num_y-1)+patch_shape_y
+
+    def batching(input, input_interp=None, out=None, materialize=True):
+        input_padded = torch.nn.functional.pad(input, padding, mode='reflect')
+        # (batch_size, C, patch_num_y, patch_num_x, patch_shape_y, patch_shape_x)
+        patches = input_padded[:,:,:covered_shape_y,:covered_shape_x].unfold(2, patch_shape_y, stride_y).unfold(3, patch_shape_x, stride_x)
+        # patches are ordered as (x_index*patch_num_y+y_index)*batch_size + batch index
+        patches = patches.permute(3, 2, 0, 1, 4, 5)
+        if not materialize:
+            if input_interp is not None or out is not None:
+                raise ValueError('input_interp and out require materialize=True')
+            return patches, (patch_num*batch_size, input.shape[1], patch_shape_y, patch_shape_x)
+        if out is not None:
+            out[:,:input.shape[1]].view(patches.shape).copy_(patches)
+            if input_interp is not None:
+                out[:,input.shape[1]:].view(patch_num, *input_interp.shape).copy_(input_interp.expand(patch_num, -1, -1, -1, -1))
+            return out
+        output = patches.contiguous().view(patch_num*batch_size, input.shape[1], patch_shape_y, patch_shape_x)
+        if input_interp is not None:
+            output = torch.cat((output, input_interp.repeat(patch_num, 1, 1, 1)), dim=1)
+        return output
+    return batching
 
 def image_batching(input, 
         img_shape_y, 
@@ -17,36 +86,63 @@ def image_batching(input,
         batch_size,
         overlap_pix,
         boundary_pix,
-        input_interp=None):
+        input_interp=None,
+        out=None,
+        geom=None,
+        materialize=True):
     '''
     full image --> batch of patched image
     batch_size: original batch size without patching
     overlap_pix: overlapping size between patches
     boundary_pix: boundary pixel size that will be cropped
+    out: optional preallocated output from a previous call with the same shapes, filled in place
+    geom: optional precomputed patch_geometry for these shapes
+    materialize: if False, return (view, shape) with the strided unfold view of the padded input instead of
+        copying the patches; view.reshape(shape) gives the patch batch once it is actually needed
     '''
-    patch_num_x = math.ceil(img_shape_x/(patch_shape_x-overlap_pix-boundary_pix))
-    patch_num_y = math.ceil(img_shape_y/(patch_shape_y-overlap_pix-boundary_pix))
-    padded_shape_x = (patch_shape_x-overlap_pix-boundary_pix) * (patch_num_x-1) + patch_shape_x + boundary_pix
-    padded_shape_y = (patch_shape_y-overlap_pix-boundary_pix) * (patch_num_y-1) + patch_shape_y + boundary_pix
-    pad_x_right = padded_shape_x - img_shape_x - boundary_pix
-    pad_y_right = padded_shape_y - img_shape_y - boundary_pix
-    input_padded = torch.zeros(input.shape[0], input.shape[1], padded_shape_y, padded_shape_x).cuda()
-    image_padding = torch.nn.ReflectionPad2d((boundary_pix, pad_x_right, boundary_pix, pad_y_right)).cuda() #(padding_left,padding_right,padding_top,padding_bottom)
-    input_padded = image_padding(input)
-    patch_num = patch_num_x*patch_num_y
-    if input_interp is not None:
-        output = torch.zeros(patch_num*batch_size, input.shape[1]+input_interp.shape[1], patch_shape_y, patch_shape_x).cuda()
-    else:
-        output = torch.zeros(patch_num*batch_size, input.shape[1], patch_shape_y, patch_shape_x).cuda() 
-    for x_index in range(patch_num_x):
-        for y_index in range(patch_num_y): 
-            x_start = x_index*(patch_shape_x-overlap_pix-boundary_pix) 
-            y_start = y_index*(patch_shape_y-overlap_pix-boundary_pix)           
-            if input_interp is not None:
-                output[(x_index*patch_num_y+y_index)*batch_size:(x_index*patch_num_y+y_index+1)*batch_size,] = torch.cat((input_padded[:,:,y_start:y_start+patch_shape_y, x_start:x_start+patch_shape_x], input_interp), dim=1)
-            else:
-                output[(x_index*patch_num_y+y_index)*batch_size:(x_index*patch_num_y+y_index+1)*batch_size,] = input_padded[:,:,y_start:y_start+patch_shape_y, x_start:x_start+patch_shape_x] 
-    return output
+    batching = precompute_unfold_view(img_shape_y, img_shape_x, patch_shape_y, patch_shape_x, batch_size, overlap_pix, boundary_pix, geom=geom)
+    return batching(input, input_interp, out=out, materialize=materialize)
+
+def _taper(length, taper_pix, device, dtype):
+    '''
+    1d weights that are flat in the middle and fall off as sin^2 over the last taper_pix pixels at both ends
+    neighbouring patches overlapping by taper_pix pixels sum to one, and no weight drops below sin^2(pi/(2*(taper_pix+1)))
+    '''
+    index = torch.arange(length, dtype=dtype, device=device)
+    edge_distance = torch.minimum(index, length-1-index) + 1 # 1 at the outermost pixels
+    ramp = (edge_distance/(max(taper_pix, 0)+1)).clamp(max=1.0)
+    return torch.sin(0.5*math.pi*ramp)**2
+
+@functools.lru_cache(maxsize=8)
+def _blend_window(crop_shape_y, crop_shape_x, taper_pix, device, dtype):
+    '''
+    separable window used to blend the cropped patches, only tapering across the overlap band
+    the returned tensor is cached and must not be modified in place
+    '''
+    window_y = _taper(crop_shape_y, taper_pix, device, dtype)
+    window_x = _taper(crop_shape_x, taper_pix, device, dtype)
+    return window_y[:,None] * window_x[None,:]
+
+@functools.lru_cache(maxsize=8)
+def _inv_weight_map(img_shape_y,
+        img_shape_x,
+        patch_shape_y,
+        patch_shape_x,
+        overlap_pix,
+        boundary_pix,
+        device,
+        dtype):
+    '''
+    reciprocal of the summed blend window weights, shared by every image_fuse call with the same geometry
+    the returned tensor is cached and must not be modified in place
+    '''
+    patch_num_x, patch_num_y, stride_x, stride_y, _, _, fold_shape_x, fold_shape_y = patch_geometry(img_shape_y, img_shape_x, patch_shape_y, patch_shape_x, overlap_pix, boundary_pix)
+    crop_shape_x = patch_shape_x-2*boundary_pix
+    crop_shape_y = patch_shape_y-2*boundary_pix
+    window = _blend_window(crop_shape_y, crop_shape_x, overlap_pix-boundary_pix, device, dtype)
+    window = window.reshape(1, crop_shape_y*crop_shape_x, 1).expand(-1, -1, patch_num_x*patch_num_y)
+    weight_map = torch.nn.functional.fold(window, output_size=(fold_shape_y, fold_shape_x), kernel_size=(crop_shape_y, crop_shape_x), stride=(stride_y, stride_x))
+    return 1.0/weight_map[:,:,:img_shape_y,:img_shape_x]
 
 def image_fuse(input,
         img_shape_y, 
@@ -55,43 +151,93 @@ def image_fuse(input,
         patch_shape_x,
         batch_size,
         overlap_pix,
-        boundary_pix
+        boundary_pix,
+        geom=None
         ):
     '''
-    batch of patched image --> full image
+    batch of patched image --> full image, overlapping patches are blended across the overlap band
+    the blending is accumulated in at least float32 and the result is cast back to the input dtype
     batch_size: original batch size without patching
     overlap_pix: overlapping size between patches
     boundary_pix: boundary pixel size that will be cropped
+    geom: optional precomputed patch_geometry for these shapes
     '''
-    patch_num_x = math.ceil(img_shape_x/(patch_shape_x-overlap_pix-boundary_pix))
-    patch_num_y = math.ceil(img_shape_y/(patch_shape_y-overlap_pix-boundary_pix))
-    padded_shape_x = (patch_shape_x-overlap_pix-boundary_pix) * (patch_num_x-1) + patch_shape_x + boundary_pix
-    padded_shape_y = (patch_shape_y-overlap_pix-boundary_pix) * (patch_num_y-1) + patch_shape_y + boundary_pix
-    pad_x_right = padded_shape_x - img_shape_x - boundary_pix
-    pad_y_right = padded_shape_y - img_shape_y - boundary_pix
-    residual_x = patch_shape_x - pad_x_right # residual pixels in the last patch
-    residual_y = patch_shape_y - pad_y_right # residual pixels in the last patch
-    output = torch.zeros(batch_size, input.shape[1], img_shape_y, img_shape_x).cuda()
-    one_map = torch.ones(1, 1, input.shape[2], input.shape[3]).cuda()
-    count_map = torch.zeros(1, 1, img_shape_y, img_shape_x).cuda() # to count the overlapping times
-
-    for x_index in range(patch_num_x):
-        for y_index in range(patch_num_y): 
-            x_start = x_index*(patch_shape_x-overlap_pix-boundary_pix) 
-            y_start = y_index*(patch_shape_y-overlap_pix-boundary_pix)  
-            if (x_index==patch_num_x-1) and (y_index!=patch_num_y-1):
-                output[:,:,y_start:y_start+patch_shape_y-2*boundary_pix, x_start:] += input[(x_index*patch_num_y+y_index)*batch_size:(x_index*patch_num_y+y_index+1)*batch_size,:,boundary_pix:patch_shape_y-boundary_pix, boundary_pix:residual_x+boundary_pix]
-                count_map[:,:,y_start:y_start+patch_shape_y-2*boundary_pix, x_start:] += one_map[:,:,boundary_pix:patch_shape_y-boundary_pix, boundary_pix:residual_x+boundary_pix]               
-            elif (y_index==patch_num_y-1) and ((x_index!=patch_num_x-1)):
-                output[:,:,y_start:, x_start:x_start+patch_shape_x-2*boundary_pix] += input[(x_index*patch_num_y+y_index)*batch_size:(x_index*patch_num_y+y_index+1)*batch_size,:,boundary_pix:residual_y+boundary_pix, boundary_pix:patch_shape_x-boundary_pix]
-                count_map[:,:,y_start:, x_start:x_start+patch_shape_x-2*boundary_pix] += one_map[:,:,boundary_pix:residual_y+boundary_pix, boundary_pix:patch_shape_x-boundary_pix]          
-            elif (x_index==patch_num_x-1 and y_index==patch_num_y-1):
-                output[:,:,y_start:, x_start:] += input[(x_index*patch_num_y+y_index)*batch_size:(x_index*patch_num_y+y_index+1)*batch_size,:,boundary_pix:residual_y+boundary_pix, boundary_pix:residual_x+boundary_pix]
-                count_map[:,:,y_start:, x_start:] += one_map[:,:,boundary_pix:residual_y+boundary_pix, boundary_pix:residual_x+boundary_pix]            
-            else:
-                output[:,:,y_start:y_start+patch_shape_y-2*boundary_pix, x_start:x_start+patch_shape_x-2*boundary_pix] += input[(x_index*patch_num_y+y_index)*batch_size:(x_index*patch_num_y+y_index+1)*batch_size,:,boundary_pix:patch_shape_y-boundary_pix, boundary_pix:patch_shape_x-boundary_pix]
-                count_map[:,:,y_start:y_start+patch_shape_y-2*boundary_pix, x_start:x_start+patch_shape_x-2*boundary_pix] += one_map[:,:,boundary_pix:patch_shape_y-boundary_pix, boundary_pix:patch_shape_x-boundary_pix]
-    return output/count_map
+    if geom is None:
+        geom = patch_geometry(img_shape_y, img_shape_x, patch_shape_y, patch_shape_x, overlap_pix, boundary_pix)
+    patch_num_x, patch_num_y, stride_x, stride_y, _, _, fold_shape_x, fold_shape_y = geom
+    patch_num = patch_num_x*patch_num_y
+    crop_shape_x = patch_shape_x-2*boundary_pix # patch size after cropping the boundary pixels
+    crop_shape_y = patch_shape_y-2*boundary_pix
+    channels = input.shape[1]
+    dtype = input.dtype
+    acc_dtype = torch.promote_types(dtype, torch.float32)
+    # crop the boundary pixels and weight the patches so overlaps blend without seams, which also promotes them to acc_dtype
+    window = _blend_window(crop_shape_y, crop_shape_x, overlap_pix-boundary_pix, input.device, acc_dtype)
+    input = input[:,:,boundary_pix:patch_shape_y-boundary_pix, boundary_pix:patch_shape_x-boundary_pix] * window
+    # (x_index*patch_num_y+y_index)*batch_size ordering --> (batch_size, C*crop_y*crop_x, y_index*patch_num_x+x_index) as expected by fold
+    input = input.reshape(patch_num_x, patch_num_y, batch_size, channels*crop_shape_y*crop_shape_x).permute(2, 3, 1, 0).reshape(batch_size, channels*crop_shape_y*crop_shape_x, patch_num)
+    fold_args = dict(output_size=(fold_shape_y, fold_shape_x), kernel_size=(crop_shape_y, crop_shape_x), stride=(stride_y, stride_x))
+    output = torch.nn.functional.fold(input, **fold_args)
+    inv_weight_map = _inv_weight_map(img_shape_y, img_shape_x, patch_shape_y, patch_shape_x, overlap_pix, boundary_pix, input.device, acc_dtype)
+    output = output[:,:,:img_shape_y,:img_shape_x]
+    # normalise the fresh fold output in place when it covers the image exactly, otherwise into a contiguous
+    # tensor so the extra fold rows/columns are freed and later elementwise ops see dense memory
+    output = output.mul_(inv_weight_map) if output.is_contiguous() else output*inv_weight_map
+    return output.to(dtype)
+
+
+def _noise_step(x_cur, noise, scale):
+    # x_cur + scale * noise, in place on x_cur which is not used afterwards
+    return x_cur.add_(noise, alpha=scale)
+
+def _euler_step(x_hat, denoised, t_hat, t_next):
+    # d_cur = (x_hat - denoised) / t_hat, in place on the denoiser output; returns x_next and d_cur
+    d_cur = denoised.sub_(x_hat).div_(-t_hat)
+    return torch.add(x_hat, d_cur, alpha=t_next - t_hat), d_cur
+
+def _heun_step(x_hat, x_next, denoised, d_cur, t_hat, t_next):
+    # x_hat + (t_next - t_hat) * (0.5 * d_cur + 0.5 * d_prime), in place on the denoiser output and d_cur
+    d_prime = denoised.sub_(x_next).div_(-t_next)
+    return torch.add(x_hat, d_cur.add_(d_prime), alpha=0.5 * (t_next - t_hat))
+
+
+class _GraphedDenoiser:
+    '''
+    denoise(x, sigma) replayed from a CUDA graph
+    the first warmup_steps calls run eagerly on a side stream, so lazily initialised library state exists before capture;
+    the next call captures the graph and later calls only copy the new x and sigma into the static inputs before replaying it
+    every call must use the same shapes, dtypes and device, and the network runs under no_grad
+    the graph belongs to a single edm_sampler call, so every sample pays the warm-up and the capture again
+    '''
+    def __init__(self, denoise, warmup_steps=3):
+        self.denoise = denoise
+        self.warmup_steps = warmup_steps
+        self.calls = 0
+        self.stream = None
+        self.graph = None
+
+    def __call__(self, x, sigma):
+        sigma = torch.as_tensor(sigma, device=x.device)
+        if self.calls < self.warmup_steps:
+            self.calls += 1
+            if self.stream is None:
+                self.stream = torch.cuda.Stream(device=x.device)
+            # the side stream waits for the caller's work and the caller waits for the result, so tensors are safely shared
+            self.stream.wait_stream(torch.cuda.current_stream(x.device))
+            with torch.cuda.stream(self.stream), torch.no_grad():
+                output = self.denoise(x, sigma)
+            torch.cuda.current_stream(x.device).wait_stream(self.stream)
+            return output
+        if self.graph is None:
+            self.static_x = x.clone()
+            self.static_sigma = sigma.clone()
+            self.graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self.graph), torch.no_grad():
+                self.static_output = self.denoise(self.static_x, self.static_sigma)
+        self.static_x.copy_(x)
+        self.static_sigma.copy_(sigma)
+        self.graph.replay()
+        return self.static_output.clone() # the static output is overwritten by the next replay
 
 
 def edm_sampler(
@@ -114,79 +260,105 @@ def edm_sampler(
     S_min=0,
     S_max=float("inf"),
     S_noise=1,
+    use_cuda_graph=False,
+    input_interp=None,
 ):  
     # Adjust noise levels based on what's supported by the network.
     "Proposed EDM sampler (Algorithm 2) with minor changes to enable super-resolution."
     sigma_min = max(sigma_min, net.sigma_min)
     #sigma_max = min(sigma_max, net.sigma_max)
 
-    # Time step discretization.
-    step_indices = torch.arange(num_steps, dtype=torch.float64, device=latents.device)
+    # Time step discretization, kept on the host so the loop below never waits on the device.
+    step_indices = np.arange(num_steps, dtype=np.float64)
     t_steps = (
         sigma_max ** (1 / rho)
         + step_indices
         / (num_steps - 1)
         * (sigma_min ** (1 / rho) - sigma_max ** (1 / rho))
     ) ** rho
+    t_steps = torch.from_numpy(t_steps)
     t_steps = torch.cat(
-        [net.round_sigma(t_steps), torch.zeros_like(t_steps[:1])]
+        [net.round_sigma(t_steps), t_steps.new_zeros(1)]
     )  # t_N = 0
+    t_steps = t_steps.tolist()
 
     b = latents.shape[0]
-    Nx = torch.arange(img_shape_x)
-    Ny = torch.arange(img_shape_y)
+    # pixel coordinates fit in int16 unless the image is wider than 32768 pixels
+    index_dtype = torch.int16 if max(img_shape_y, img_shape_x) - 1 <= torch.iinfo(torch.int16).max else torch.int32
+    Nx = torch.arange(img_shape_x, dtype=index_dtype, device=latents.device)
+    Ny = torch.arange(img_shape_y, dtype=index_dtype, device=latents.device)
     grid = torch.stack(torch.meshgrid(Ny, Nx, indexing="ij"), dim=0)[None,].expand(b, -1, -1, -1)
 
     # conditioning = [mean_hr, img_lr, global_lr, pos_embd]
     batch_size = img_lr.shape[0]
+    img_lr = img_lr.to(latents.device)
+    if input_interp is not None:
+        input_interp = input_interp.to(latents.device)
     x_lr = img_lr
     if mean_hr is not None:
-        x_lr = torch.cat((mean_hr.expand(x_lr.shape[0], -1, -1, -1), x_lr), dim=1)
+        x_lr = torch.cat((mean_hr.to(latents.device).expand(x_lr.shape[0], -1, -1, -1), x_lr), dim=1)
     global_index = None        
         
     # input and position padding + patching
     if (patch_shape!=img_shape_x or patch_shape!=img_shape_y):
-        input_interp = torch.nn.functional.interpolate(img_lr, (patch_shape, patch_shape), mode='bilinear') 
-        x_lr = image_batching(x_lr, img_shape_y, img_shape_x, patch_shape, patch_shape, batch_size, overlap_pix, boundary_pix, input_interp)
-        global_index = image_batching(grid.float(), img_shape_y, img_shape_x, patch_shape, patch_shape, batch_size, overlap_pix, boundary_pix).int() 
+        geom = patch_geometry(img_shape_y, img_shape_x, patch_shape, patch_shape, overlap_pix, boundary_pix)
+        if input_interp is None:
+            # callers sampling repeatedly from the same img_lr can pass the resized input_interp to skip this
+            input_interp = torch.nn.functional.interpolate(img_lr, (patch_shape, patch_shape), mode='bilinear')
+        batching = precompute_unfold_view(img_shape_y, img_shape_x, patch_shape, patch_shape, batch_size, overlap_pix, boundary_pix, geom=geom)
+        x_lr = batching(x_lr, input_interp)
+        global_index = batching(grid).int() # the network indexes its positional embedding with it, which needs int32
             
+    def denoise(x, sigma):
+        return net(x, x_lr, sigma, class_labels, global_index=global_index)
+    if use_cuda_graph and latents.is_cuda:
+        # shapes are fixed across steps, so the network forward pass can be replayed from a CUDA graph
+        denoise = _GraphedDenoiser(denoise)
+
     # Main sampling loop.
-    x_next = latents.to(torch.float64) * t_steps[0]
-    for i, (t_cur, t_next) in enumerate(zip(t_steps[:-1], t_steps[1:])):  # 0, ..., N-1
+    x_next = latents.to(torch.float32) * t_steps[0]
+    x_hat_batch = x_next_batch = None # patch buffers, allocated on the first step and refilled afterwards
+    t_hat_sigma = torch.empty((), dtype=torch.float64, device=latents.device) # noise levels handed to the network, refilled every step
+    t_next_sigma = torch.empty_like(t_hat_sigma)
+    for i in range(num_steps):  # 0, ..., N-1
+        t_cur = t_steps[i]
+        t_next = t_steps[i + 1]
         x_cur = x_next
         # Increase noise temporarily.
         gamma = (
             S_churn / num_steps if S_min <= t_cur <= S_max else 0
         )
-        t_hat = net.round_sigma(t_cur + gamma * t_cur)
+        t_hat = t_cur + gamma * t_cur
+        if gamma > 0: # t_cur itself is already rounded
+            t_hat = float(net.round_sigma(torch.tensor(t_hat, dtype=torch.float64)))
+        t_hat_sigma.fill_(t_hat)
+        t_next_sigma.fill_(t_next)
 
-        x_hat = x_cur + (t_hat**2 - t_cur**2).sqrt() * S_noise * randn_like(x_cur)        
-        if torch.cuda.current_device()==0:
-            print(torch.sum(x_cur**2), torch.sum(x_hat**2))
+        x_hat = _noise_step(x_cur, randn_like(x_cur), (t_hat**2 - t_cur**2) ** 0.5 * S_noise)
         # Euler step. Perform patching operation on score tensor if patch-based generation is used
-        # denoised = net(x_hat, t_hat, class_labels).to(torch.float64)    #x_lr
-        
         if (patch_shape!=img_shape_x or patch_shape!=img_shape_y):
-            x_hat_batch = image_batching(x_hat, img_shape_y, img_shape_x, patch_shape, patch_shape, batch_size, overlap_pix, boundary_pix)
+            x_hat_batch = batching(x_hat, out=x_hat_batch)
         else:
             x_hat_batch = x_hat
-        denoised = net(x_hat_batch, x_lr, t_hat, class_labels, global_index=global_index).to(torch.float64)
+        denoised = denoise(x_hat_batch, t_hat_sigma)
         if (patch_shape!=img_shape_x or patch_shape!=img_shape_y):
-            denoised = image_fuse(denoised, img_shape_y, img_shape_x, patch_shape, patch_shape, batch_size, overlap_pix, boundary_pix)     
-        d_cur = (x_hat - denoised) / t_hat
-        x_next = x_hat + (t_next - t_hat) * d_cur
+            denoised = image_fuse(denoised.to(torch.float32), img_shape_y, img_shape_x, patch_shape, patch_shape, batch_size, overlap_pix, boundary_pix, geom=geom)
+        else:
+            denoised = denoised.to(torch.float32, copy=True) # updated in place below, so never alias the network output
+        x_next, d_cur = _euler_step(x_hat, denoised, t_hat, t_next)
 
-        # Apply 2nd order correction.
+        # Apply 2nd order correction. x_next depends on the Euler denoiser output,
+        # so this forward pass cannot be batched together with the one above.
         if i < num_steps - 1:
             if (patch_shape!=img_shape_x or patch_shape!=img_shape_y):
-                x_next_batch = image_batching(x_next, img_shape_y, img_shape_x, patch_shape, patch_shape, batch_size, overlap_pix, boundary_pix)
+                x_next_batch = batching(x_next, out=x_next_batch)
             else:
                 x_next_batch = x_next
-            # ask about this fix
-            denoised = net(x_next_batch, x_lr, t_next, class_labels, global_index=global_index).to(torch.float64)
+            denoised = denoise(x_next_batch, t_next_sigma)
             if (patch_shape!=img_shape_x or patch_shape!=img_shape_y):
-                denoised = image_fuse(denoised, img_shape_y, img_shape_x, patch_shape, patch_shape, batch_size, overlap_pix, boundary_pix)
-            d_prime = (x_next - denoised) / t_next
-            x_next = x_hat + (t_next - t_hat) * (0.5 * d_cur + 0.5 * d_prime)
+                denoised = image_fuse(denoised.to(torch.float32), img_shape_y, img_shape_x, patch_shape, patch_shape, batch_size, overlap_pix, boundary_pix, geom=geom)
+            else:
+                denoised = denoised.to(torch.float32, copy=True) # updated in place below, so never alias the network output
+            x_next = _heun_step(x_hat, x_next, denoised, d_cur, t_hat, t_next)
     return x_next
     
\ No newline at end of file
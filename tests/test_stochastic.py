@@ -0,0 +1,77 @@
+import importlib.util
+import math
+import pathlib
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+# load stochastic.py by path: the package __init__ also imports augment, which needs modulus, while stochastic does not
+_spec = importlib.util.spec_from_file_location("edmss_stochastic", pathlib.Path(__file__).parents[1] / "edmss" / "stochastic.py")
+stochastic = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(stochastic)
+
+IMG_SHAPE_Y, IMG_SHAPE_X, PATCH_SHAPE, OVERLAP_PIX, BOUNDARY_PIX, BATCH_SIZE = 150, 200, 64, 4, 2, 2
+
+
+def _patch_loop(image, input_interp=None):
+    # per-patch slicing as done by the original image_batching loop
+    stride = PATCH_SHAPE-OVERLAP_PIX-BOUNDARY_PIX
+    patch_num_x = math.ceil(IMG_SHAPE_X/stride)
+    patch_num_y = math.ceil(IMG_SHAPE_Y/stride)
+    pad_x_right = stride*(patch_num_x-1) + PATCH_SHAPE - IMG_SHAPE_X
+    pad_y_right = stride*(patch_num_y-1) + PATCH_SHAPE - IMG_SHAPE_Y
+    image_padded = torch.nn.functional.pad(image, (BOUNDARY_PIX, pad_x_right, BOUNDARY_PIX, pad_y_right), mode='reflect')
+    patches = []
+    for x_index in range(patch_num_x):
+        for y_index in range(patch_num_y):
+            x_start = x_index*stride
+            y_start = y_index*stride
+            patch = image_padded[:,:,y_start:y_start+PATCH_SHAPE, x_start:x_start+PATCH_SHAPE]
+            if input_interp is not None:
+                patch = torch.cat((patch, input_interp), dim=1)
+            patches.append(patch)
+    return torch.cat(patches)
+
+
+def _batching_inputs(with_interp):
+    image = torch.randn(BATCH_SIZE, 3, IMG_SHAPE_Y, IMG_SHAPE_X)
+    input_interp = torch.randn(BATCH_SIZE, 2, PATCH_SHAPE, PATCH_SHAPE) if with_interp else None
+    return image, input_interp
+
+
+@pytest.mark.parametrize("with_interp", [False, True])
+def test_image_batching_matches_patch_loop(with_interp):
+    image, input_interp = _batching_inputs(with_interp)
+    patches = stochastic.image_batching(image, IMG_SHAPE_Y, IMG_SHAPE_X, PATCH_SHAPE, PATCH_SHAPE, BATCH_SIZE, OVERLAP_PIX, BOUNDARY_PIX, input_interp)
+    assert torch.equal(patches, _patch_loop(image, input_interp))
+
+
+@pytest.mark.parametrize("dtype", [torch.float16, torch.bfloat16])
+@pytest.mark.parametrize("img_shape_y, img_shape_x, patch_shape", [(150, 200, 64), (896, 896, 448)])
+def test_image_fuse_recovers_batched_image(dtype, img_shape_y, img_shape_x, patch_shape):
+    batch_size, overlap_pix, boundary_pix = 2, 4, 2
+    image = torch.randn(batch_size, 3, img_shape_y, img_shape_x)
+    patches = stochastic.image_batching(image, img_shape_y, img_shape_x, patch_shape, patch_shape, batch_size, overlap_pix, boundary_pix)
+    fused = stochastic.image_fuse(patches.to(dtype), img_shape_y, img_shape_x, patch_shape, patch_shape, batch_size, overlap_pix, boundary_pix)
+    assert fused.dtype == dtype
+    assert torch.isfinite(fused).all()
+    torch.testing.assert_close(fused.float(), image.to(dtype).float(), rtol=1e-2, atol=1e-3)
+
+
+@pytest.mark.parametrize("with_interp", [False, True])
+def test_image_batching_fills_out(with_interp):
+    image, input_interp = _batching_inputs(with_interp)
+    expected = _patch_loop(image, input_interp)
+    out = torch.empty_like(expected)
+    patches = stochastic.image_batching(image, IMG_SHAPE_Y, IMG_SHAPE_X, PATCH_SHAPE, PATCH_SHAPE, BATCH_SIZE, OVERLAP_PIX, BOUNDARY_PIX, input_interp, out=out)
+    assert patches is out
+    assert torch.equal(out, expected)
+
+
+def test_image_batching_unmaterialized_view():
+    image, _ = _batching_inputs(False)
+    view, shape = stochastic.image_batching(image, IMG_SHAPE_Y, IMG_SHAPE_X, PATCH_SHAPE, PATCH_SHAPE, BATCH_SIZE, OVERLAP_PIX, BOUNDARY_PIX, materialize=False)
+    assert torch.equal(view.reshape(shape), _patch_loop(image))
+    with pytest.raises(ValueError):
+        stochastic.image_batching(image, IMG_SHAPE_Y, IMG_SHAPE_X, PATCH_SHAPE, PATCH_SHAPE, BATCH_SIZE, OVERLAP_PIX, BOUNDARY_PIX, out=torch.empty(shape), materialize=False)